@@ -10,7 +10,9 @@ IMDB Project — Run Queries (Q1..Q50) and Export Results
     * Individual CSV files in an output folder.
 
 USAGE (install requirements first): 
-    pip install mysql-connector-python pandas openpyxl
+    pip install mysql-connector-python pandas xlsxwriter
+    (mysql-connector-python wheels include the C extension, which is used when present)
+    (openpyxl also works; it is used in write-only mode when xlsxwriter is missing)
 
     # Example (password inline):
     python run_imdb_queries_to_excel.py --host localhost --user root --password "project@sql" \
@@ -31,124 +33,509 @@ USAGE (install requirements first):
 Notes:
 - The script assumes you have a running MySQL (or MariaDB) instance and credentials.
 - It is idempotent-ish: it executes your dataset file; use --skip_setup to skip reloading.
+- Use --skip_excel when only the CSV files are needed; the workbook is then not built at all.
+- The parsed solved SQL and the query results (parquet, needs pyarrow) are cached in
+  --cache_dir; pass --no_cache to re-parse and force every query to run again.
+  Result caching is only used when setup runs, i.e. never together with --skip_setup.
 """
 
 import argparse
+import csv
+import datetime
 import getpass
+import hashlib
+import json
 import os
 import re
 import sys
-from typing import List, Tuple, Dict
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from typing import Callable, List, Tuple, Dict, Optional
 
 import pandas as pd
 import mysql.connector
 from mysql.connector import errorcode
+from mysql.connector.pooling import MySQLConnectionPool
+
+try:
+    from mysql.connector import HAVE_CEXT  # C extension: native protocol parsing / row decoding
+except ImportError:
+    HAVE_CEXT = False
+
+try:
+    import xlsxwriter
+    HAVE_XLSXWRITER = True
+except ImportError:
+    HAVE_XLSXWRITER = False
+
+try:
+    import pyarrow  # noqa: F401  (parquet engine for the result cache)
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+MAX_BATCH_BYTES = 1 << 20  # stays well under MySQL's default max_allowed_packet
+MAX_POOL_SIZE = 32  # mysql.connector.pooling.CNX_POOL_MAXSIZE
+FETCH_SIZE = 10_000  # rows per fetchmany() from the unbuffered cursor
+RESULT_LOOKAHEAD = 3  # finished results allowed to queue up ahead of the writer
+MAX_BUFFERED_RESULTS = 4  # full result sets held in memory at once while building the workbook
+XLSXWRITER_OPTIONS = {
+    'constant_memory': True,       # rows are flushed as written; must be written in row order
+    'strings_to_numbers': False,
+    'nan_inf_to_errors': True,
+    'default_date_format': 'yyyy-mm-dd',  # DATE; see EXCEL_TIME_FORMATS for the rest
+}
+# Number formats for time-like cells (checked in order: datetime subclasses date)
+EXCEL_TIME_FORMATS = (
+    (datetime.datetime, 'yyyy-mm-dd hh:mm:ss'),
+    (datetime.timedelta, '[h]:mm:ss'),  # MySQL TIME can exceed 24h
+    (datetime.time, 'hh:mm:ss'),
+)
+_TIME_TYPES = tuple(t for t, _ in EXCEL_TIME_FORMATS)
+BULK_LOAD_SESSION_VARS = ('unique_checks', 'foreign_key_checks', 'sql_log_bin')
+
+_INLINE_BLOCK = re.compile(r'/\*.*?\*/')
+_Q_LINE = re.compile(r'\s*--\s*Q\d+', re.IGNORECASE)
+_SEG = re.compile(r'Segment\s+\d+', re.IGNORECASE)
+_SEG1 = re.compile(r'\bSegment\s*1\b', re.IGNORECASE)
+_LINE_COMMENT = re.compile(r'--.*$')
+_Q_PAT = re.compile(r'^\s*--\s*(Q\d+)\s*[—\-–]*\s*(.*)$', re.IGNORECASE | re.MULTILINE)
+_Q_SQL = re.compile(r'(?is)\b(SELECT|WITH\b.+?SELECT)\b.*?;')
+_NON_DIGIT = re.compile(r'\D')
+_SHEET_TRANS = str.maketrans({'/': '_', '\\': '_', ':': ' ', '*': ' ', '?': ' ', '[': '(', ']': ')'})
+# Keywords match case-insensitively; the table and column list are compared as written
+_INSERT_VALUES = re.compile(r'INSERT\s+INTO\s+(`?\w+`?)\s*(\([^)]*\))?\s*VALUES\s*(.*)', re.IGNORECASE | re.DOTALL)
+_ON_DUPLICATE = re.compile(r'\bON\s+DUPLICATE\s+KEY\b', re.IGNORECASE)
+# One statement body: plain runs, backslash escapes, or quoted strings (an
+# unterminated quote runs to EOF). A match always stops at a ';' or at EOF.
+_SQL_STMT = re.compile(r"""(?:[^;'"\\]+|\\[^;]?|'[^'\\]*(?:\\.[^'\\]*)*(?:'|\\?\Z)|"[^"\\]*(?:\\.[^"\\]*)*(?:"|\\?\Z))*""", re.DOTALL)
 
 def read_text(path: str) -> str:
-    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-        return f.read()
+    # Unbuffered binary read: one read() sized to the file instead of 8 KiB chunks
+    with open(path, 'rb', buffering=0) as f:
+        data = f.read()
+    text = data.decode('utf-8', errors='ignore')
+    if '\r' in text:  # match text-mode universal newlines
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
 
-def split_mysql_statements(sql_text: str) -> List[str]:
+def _filter_sql_lines(sql_text: str):
     """
-    Naive but practical splitter that respects quotes and semicolons.
-    Keeps lines that start with '-- Q' or contain 'Segment <n>' labels.
-    Strips other comments.
+    Yield (end_offset, line) for every line outside multi-line /* */ blocks, with
+    inline /* ... */ removed and '--' comments stripped unless the line is a
+    '-- Q' or 'Segment <n>' label. `end_offset` is where the raw line ends.
     """
-    lines = sql_text.splitlines()
-    kept = []
     in_block = False
-    for line in lines:
-        l = line
+    end_offset = 0
+    for raw_line in sql_text.splitlines(keepends=True):
+        end_offset += len(raw_line)
+        l = raw_line.splitlines()[0]
         if '/*' in l and '*/' not in l:
             in_block = True
         if in_block:
             if '*/' in l:
                 in_block = False
             continue
-        l = re.sub(r'/\*.*?\*/', ' ', l)  # inline /* ... */
-        if re.match(r'\s*--\s*Q\d+', l, flags=re.IGNORECASE) or re.search(r'Segment\s+\d+', l, flags=re.IGNORECASE):
-            kept.append(l)
-            continue
-        l = re.sub(r'--.*$', '', l)  # strip other -- comments
-        kept.append(l)
-    text = '\n'.join(kept)
+        l = _INLINE_BLOCK.sub(' ', l)  # inline /* ... */
+        if not (_Q_LINE.match(l) or _SEG.search(l)):
+            l = _LINE_COMMENT.sub('', l)  # strip other -- comments
+        yield end_offset, l
+
+def split_mysql_statements(sql_text: str) -> List[str]:
+    """
+    Naive but practical splitter that respects quotes and semicolons.
+    Keeps lines that start with '-- Q' or contain 'Segment <n>' labels.
+    Strips other comments.
+    """
+    text = '\n'.join(l for _, l in _filter_sql_lines(sql_text))
 
     stmts = []
-    buff = []
-    in_single = False
-    in_double = False
-    esc = False
-    for ch in text:
-        if ch == "'" and not in_double and not esc:
-            in_single = not in_single
-        elif ch == '"' and not in_single and not esc:
-            in_double = not in_double
-        if ch == ';' and not in_single and not in_double:
-            stmts.append(''.join(buff).strip())
-            buff = []
-        else:
-            buff.append(ch)
-        esc = (ch == '\\' and not esc)
-    if buff:
-        tail = ''.join(buff).strip()
-        if tail:
-            stmts.append(tail)
+    pos, end = 0, len(text)
+    while pos < end:
+        m = _SQL_STMT.match(text, pos)
+        stmts.append(m.group().strip())
+        pos = m.end() + 1  # skip the ';'
     return [s for s in stmts if s.strip()]
 
 def extract_setup_and_queries(solved_sql_text: str) -> Tuple[List[str], Dict[str, Dict[str, str]]]:
     """
     Return:
       - setup_statements: list of SQL statements to run BEFORE Q1 (i.e., everything before 'Segment 1')
-      - queries: dict keyed by 'Q01'.., value contains {'label': 'Q01 — ...', 'sql': 'SELECT ...'}
+      - queries: dict keyed by 'Q01'.., value contains {'label': 'Q01 — ...', 'sql': 'SELECT ...',
+        'sheet': 'Q01_...'} where 'sheet' is a sanitized, unique Excel sheet name (<=31 chars)
     """
     raw = solved_sql_text
-    statements = split_mysql_statements(raw)
-
-    # Separate setup vs rest by first "Segment 1"
-    seg1_idx = None
-    for i, s in enumerate(statements):
-        if re.search(r'\bSegment\s*1\b', s, flags=re.IGNORECASE):
-            seg1_idx = i
-            break
-    if seg1_idx is None:
-        setup_statements = statements
-    else:
-        setup_statements = statements[:seg1_idx]
+
+    # Setup is every statement before the first one containing "Segment 1". Only the
+    # text up to the end of the first line whose comment-filtered form holds the
+    # marker is split; statements never depend on text that follows them.
+    cut = next((end for end, l in _filter_sql_lines(raw) if _SEG1.search(l)), len(raw))
+    statements = split_mysql_statements(raw[:cut])
+    seg1_idx = next((i for i, s in enumerate(statements) if _SEG1.search(s)), None)
+    setup_statements = statements if seg1_idx is None else statements[:seg1_idx]
 
     # Use raw text to capture Q labels & blocks
-    q_pat = re.compile(r'^\s*--\s*(Q\d+)\s*[—\-–]*\s*(.*)$', re.IGNORECASE | re.MULTILINE)
-    q_positions = [(m.group(1).upper(), m.start(), m.group(0)) for m in q_pat.finditer(raw)]
+    q_positions = [(m.group(1).upper(), m.start(), m.group(0)) for m in _Q_PAT.finditer(raw)]
     queries: Dict[str, Dict[str, str]] = {}
 
     for idx, (qkey, start_pos, label_line) in enumerate(q_positions):
         end_pos = q_positions[idx + 1][1] if idx + 1 < len(q_positions) else len(raw)
         block = raw[start_pos:end_pos]
-        m = re.search(r'(?is)\b(SELECT|WITH\b.+?SELECT)\b.*?;', block)
+        m = _Q_SQL.search(block)
         if not m:
             continue
         sql = m.group(0).strip().rstrip(';')
-        qnum = int(re.sub(r'\D', '', qkey))
+        qnum = int(_NON_DIGIT.sub('', qkey))
         qstd = f"Q{qnum:02d}"
         label = label_line.strip().lstrip('-').strip()
         queries[qstd] = {"label": label, "sql": sql}
 
+    used = set()  # Excel sheet names are case-insensitive
+    for qstd in sorted(queries.keys()):
+        sheet = base = f"{qstd}_{queries[qstd]['label']}".translate(_SHEET_TRANS)[:31]
+        n = 2
+        while sheet.lower() in used:
+            suffix = f"~{n}"
+            sheet = base[:31 - len(suffix)] + suffix
+            n += 1
+        used.add(sheet.lower())
+        queries[qstd]['sheet'] = sheet
+
     return setup_statements, queries
 
-def run_statements(cur, statements: List[str], echo=False):
+def load_setup_and_queries(solved_sql_text: str, cache_dir: Optional[str] = None
+                           ) -> Tuple[List[str], Dict[str, Dict[str, str]]]:
+    """
+    extract_setup_and_queries(), memoized in `cache_dir` as JSON keyed on the sha256
+    of this script's source plus the SQL text, so editing either invalidates it.
+    """
+    if not cache_dir:
+        return extract_setup_and_queries(solved_sql_text)
+    with open(__file__, 'rb') as f:
+        h = hashlib.sha256(f.read())
+    h.update(solved_sql_text.encode('utf-8'))
+    path = os.path.join(cache_dir, f"parsed_{h.hexdigest()}.json")
+    try:
+        with open(path, encoding='utf-8') as f:
+            setup_statements, queries = json.load(f)
+        return setup_statements, queries
+    except FileNotFoundError:
+        pass
+    except Exception as e:  # corrupt/truncated cache file: re-parse
+        print(f"[WARN] Ignoring unreadable parse cache {path}: {e}")
+    parsed = extract_setup_and_queries(solved_sql_text)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(parsed, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[WARN] Could not write parse cache {path}: {e}")
+    return parsed
+
+def coalesce_inserts(statements: List[str], max_bytes: int = MAX_BATCH_BYTES) -> List[Tuple[str, List[str]]]:
+    """
+    Merge consecutive `INSERT INTO <table> [(cols)] VALUES ...` statements that share
+    the same target into one multi-row INSERT (capped at `max_bytes` of UTF-8).
+    Returns (sql_to_execute, original_statements) pairs, in order.
+    """
+    batches: List[Tuple[str, List[str]]] = []
+    key, head, values, parts, size = None, None, [], [], 0
+
+    def flush():
+        if parts:
+            sql = parts[0] if len(parts) == 1 else f"{head} {','.join(values)}"
+            batches.append((sql, parts))
+
     for s in statements:
         s2 = s.strip()
         if not s2:
             continue
-        if echo:
-            print(f"-- Executing: {s2[:120]}{'...' if len(s2)>120 else ''}")
+        m = _INSERT_VALUES.match(s2)
+        if not m or _ON_DUPLICATE.search(m.group(3)):
+            flush()
+            key, head, values, parts, size = None, None, [], [], 0
+            batches.append((s2, [s2]))
+            continue
+        k = (m.group(1).strip('`'), ' '.join((m.group(2) or '').split()))
+        nbytes = len(s2.encode('utf-8'))
+        if k != key or size + nbytes > max_bytes:
+            flush()
+            key, head, values, parts, size = k, s2[:m.start(3)].rstrip(), [], [], 0
+        values.append(m.group(3))
+        parts.append(s2)
+        size += nbytes
+    flush()
+    return batches
+
+def execute_statement(cur, stmt: str, echo=False, warn=True) -> bool:
+    if echo:
+        print(f"-- Executing: {stmt[:120]}{'...' if len(stmt)>120 else ''}")
+    try:
+        cur.execute(stmt)
+        while True:
+            _ = cur.fetchall() if cur.with_rows else None
+            if not cur.next_result():
+                break
+    except mysql.connector.Error as e:
+        if warn:
+            print(f"[WARN] Skipping failed statement:\n{stmt}\nError: {e}")
+        return False
+    return True
+
+def run_statements(cur, statements: List[str], echo=False, cnx=None):
+    """
+    Execute statements in order, skipping (and warning about) failures.
+    If `cnx` is given, the whole run is wrapped in one transaction so DML
+    commits once instead of per statement (DDL still commits implicitly).
+    """
+    if cnx is not None and not cnx.in_transaction:
+        cnx.start_transaction()
+    try:
+        for sql, parts in coalesce_inserts(statements):
+            if len(parts) == 1:
+                execute_statement(cur, sql, echo=echo)
+                continue
+            if echo:
+                print(f"-- Executing batched INSERT of {len(parts)} statements: {sql[:80]}...")
+            if not execute_statement(cur, sql, warn=False):
+                # Retry one by one so a bad row only skips its own statement
+                for s in parts:
+                    execute_statement(cur, s, echo=echo)
+    except BaseException:
+        if cnx is not None:
+            cnx.rollback()
+        raise
+    if cnx is not None:
+        cnx.commit()
+
+def set_bulk_load_mode(cur, enabled: bool):
+    """Toggle session checks that slow down bulk loads (sql_log_bin needs SUPER; skipped if denied)."""
+    value = 0 if enabled else 1
+    for var in BULK_LOAD_SESSION_VARS:
         try:
-            cur.execute(s2)
-            while True:
-                _ = cur.fetchall() if cur.with_rows else None
-                if not cur.next_result():
-                    break
+            cur.execute(f"SET SESSION {var} = {value}")
         except mysql.connector.Error as e:
-            print(f"[WARN] Skipping failed statement:\n{s2}\nError: {e}")
+            if enabled:
+                print(f"[WARN] Could not set {var}={value}: {e}")
+
+def rows_to_frame(cols: List[str], rows: list) -> pd.DataFrame:
+    """
+    Build a DataFrame from cursor rows. With pyarrow, columns are converted
+    into typed Arrow arrays in C instead of boxing every cell as an object.
+    """
+    if HAVE_PYARROW and rows and len(set(cols)) == len(cols):
+        import pyarrow as pa
+        try:
+            table = pa.table({c: pa.array(col) for c, col in zip(cols, zip(*rows))})
+            return table.to_pandas(types_mapper=pd.ArrowDtype)
+        except pa.ArrowException:
+            pass  # mixed-type column: fall back to object dtype
+    return pd.DataFrame(rows, columns=cols)
+
+def result_cache_path(cache_dir: str, qkey: str, sql: str, data_version: str) -> str:
+    digest = hashlib.sha256(f"{data_version}\0{sql}".encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{qkey}_{digest}.parquet")
+
+def load_cached_result(path: str, min_mtime: float) -> Optional[Tuple[List[str], list]]:
+    """Return (columns, rows) from a cached parquet file newer than `min_mtime`, else None."""
+    try:
+        if os.path.getmtime(path) <= min_mtime:
+            return None
+        df = pd.read_parquet(path)
+    except Exception:
+        return None
+    df = df.astype(object).where(df.notna(), None)  # NaN back to NULL
+    for c in df.columns:
+        # TIME columns come back as pd.Timedelta; restore datetime.timedelta (str() differs)
+        values = df[c].tolist()
+        if any(isinstance(v, pd.Timedelta) for v in values):
+            df[c] = pd.Series([v.to_pytimedelta() if isinstance(v, pd.Timedelta) else v for v in values],
+                              index=df.index, dtype=object)
+    return list(df.columns), list(df.itertuples(index=False, name=None))
+
+def save_cached_result(path: str, cols: List[str], rows: list):
+    # Write to a private temp file and rename, so readers never see a partial file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        rows_to_frame(cols, rows).to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+    except Exception as e:  # e.g. duplicate column names or mixed-type columns
+        print(f"[WARN] Could not cache result to {path}: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def fetch_query(get_cursor: Callable, sql: str, csv_path: str, cache_path: Optional[str] = None,
+                min_mtime: float = 0.0, fetch_size: int = FETCH_SIZE,
+                keep_rows: bool = True) -> Tuple[List[str], list]:
+    """
+    Run one query on the cursor returned by `get_cursor()`, stream its rows to
+    `csv_path` in `fetch_size` chunks, and return (columns, rows).
+    With `cache_path`, a fresh cached result is reused and new results are cached.
+    With keep_rows=False (CSV-only runs) rows are not held once written, unless
+    they are needed for the cache; an empty row list is returned.
+    """
+    if cache_path:
+        cached = load_cached_result(cache_path, min_mtime)
+        if cached is not None:
+            write_csv(csv_path, *cached)
+            return cached
+    cur = get_cursor()
+    cur.execute(sql)
+    cols = [d[0] for d in cur.description] if cur.description else []
+    rows = []
+    collect = keep_rows or bool(cache_path)
+    with open_csv(csv_path, cols) as w:
+        for chunk in iter(lambda: cur.fetchmany(fetch_size), []):
+            w.writerows(chunk)
+            if collect:
+                rows.extend(chunk)
+    if cache_path:
+        save_cached_result(cache_path, cols, rows)
+    return cols, rows if keep_rows else []
+
+def run_queries(pool: MySQLConnectionPool, queries: Dict[str, Dict[str, str]], workers: int,
+                lookahead: int = RESULT_LOOKAHEAD, max_buffered: Optional[int] = None,
+                **fetch_kwargs):
+    """
+    Yield (qkey, (columns, rows) or mysql.connector.Error) in Q-order while later
+    queries keep executing, so writing one result overlaps fetching the next.
+    At most `workers + lookahead` results are pending at once. When the rows are
+    kept (for the workbook), `max_buffered` caps the results in memory at once,
+    counting the one the caller is still writing; 1 runs the queries serially.
+    Each query's CSV ('csv' path) is written by its worker (see fetch_query);
+    its optional 'cache' path points at the parquet result cache.
+
+    Every worker thread checks out one pooled connection and reuses its
+    unbuffered cursor for all of its queries, instead of paying a checkout
+    (and session reset) per query. A cursor that hits an error is discarded.
+    """
+    local = threading.local()
+    connections = set()
+
+    def get_cursor():
+        if getattr(local, 'cur', None) is None:
+            cnx = pool.get_connection()
+            try:
+                cur = cnx.cursor(buffered=False)
+            except Exception:
+                cnx.close()
+                raise
+            connections.add(cnx)
+            local.cnx, local.cur = cnx, cur
+        return local.cur
+
+    def release(cnx):
+        connections.discard(cnx)
+        try:
+            cnx.close()  # returns the connection to the pool
+        except mysql.connector.Error:
+            pass
+
+    def run_one(sql, csv_path, cache_path):
+        try:
+            return fetch_query(get_cursor, sql, csv_path, cache_path=cache_path, **fetch_kwargs)
+        except Exception:
+            if getattr(local, 'cur', None) is not None:
+                local.cur = None
+                release(local.cnx)
+            raise
+
+    def pop(pending):
+        qkey, fut = pending.popleft()
+        try:
+            return qkey, fut.result()
+        except mysql.connector.Error as e:
+            return qkey, e
+
+    window = workers + lookahead
+    if max_buffered is not None:
+        window = min(window, max_buffered - 1)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            pending = deque()
+            for qkey in sorted(queries.keys()):
+                q = queries[qkey]
+                fut = ex.submit(run_one, q['sql'], q['csv'], q.get('cache'))
+                pending.append((qkey, fut))
+                while len(pending) > window:
+                    yield pop(pending)
+            while pending:
+                yield pop(pending)
+    finally:
+        for cnx in list(connections):
+            release(cnx)
+
+@contextmanager
+def open_workbook(path: str):
+    """
+    Yield a workbook handle for write_sheet(), saved to `path` on exit.
+    Uses xlsxwriter directly in constant_memory mode when available, otherwise
+    falls back to a write-only openpyxl workbook. Both stream rows in order
+    without building a cell grid or going through pandas' ExcelFormatter.
+    """
+    if HAVE_XLSXWRITER:
+        with xlsxwriter.Workbook(path, XLSXWRITER_OPTIONS) as wb:
+            yield wb
+    else:
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        yield wb
+        wb.save(path)
+
+def write_sheet(book, sheet_name: str, cols: List[str], rows: list):
+    if HAVE_XLSXWRITER and isinstance(book, xlsxwriter.Workbook):
+        ws = book.add_worksheet(sheet_name)
+        ws.write_row(0, 0, cols)
+        formats = {}
+        for i, row in enumerate(rows, 1):
+            if not any(isinstance(v, _TIME_TYPES) for v in row):
+                ws.write_row(i, 0, row)
+                continue
+            # default_date_format alone would render DATETIME/TIME cells as bare dates
+            for j, v in enumerate(row):
+                fmt_str = next((f for t, f in EXCEL_TIME_FORMATS if isinstance(v, t)), None)
+                if fmt_str is None:
+                    ws.write(i, j, v)
+                    continue
+                if fmt_str not in formats:
+                    formats[fmt_str] = book.add_format({'num_format': fmt_str})
+                ws.write_datetime(i, j, v, formats[fmt_str])
+        return
+    ws = book.create_sheet(sheet_name)
+    ws.append(tuple(cols))
+    for row in rows:
+        ws.append(row)
+
+@contextmanager
+def open_csv(path: str, cols: List[str]):
+    """Yield a csv.writer for `path` with the header row already written."""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        w.writerow(cols)
+        yield w
+
+def write_csv(path: str, cols: List[str], rows: list):
+    with open_csv(path, cols) as w:
+        w.writerows(rows)
+
+def positive_int_arg(value: str) -> int:
+    """argparse type for counts and sizes that must be at least 1."""
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {n}")
+    return n
+
+def pool_size_arg(value: str) -> int:
+    """argparse type for --workers: MySQLConnectionPool accepts 1..MAX_POOL_SIZE."""
+    n = int(value)
+    if not 1 <= n <= MAX_POOL_SIZE:
+        raise argparse.ArgumentTypeError(f"must be between 1 and {MAX_POOL_SIZE}, got {n}")
+    return n
 
 def main():
     ap = argparse.ArgumentParser()
@@ -162,6 +549,18 @@ def main():
     ap.add_argument('--excel_out', default='IMDB_Q01_Q50_Results.xlsx')
     ap.add_argument('--csv_dir', default='csv_results')
     ap.add_argument('--skip_setup', action='store_true')
+    ap.add_argument('--skip_excel', action='store_true',
+                    help='Only write the per-query CSV files (no workbook).')
+    ap.add_argument('--workers', type=pool_size_arg, default=8,
+                    help=f'Queries executed concurrently (one pooled connection each, 1..{MAX_POOL_SIZE}).')
+    ap.add_argument('--fetch_size', type=positive_int_arg, default=FETCH_SIZE,
+                    help='Rows fetched per round-trip while streaming results.')
+    ap.add_argument('--max_buffered_results', type=positive_int_arg, default=MAX_BUFFERED_RESULTS,
+                    help='Query results held in memory at once while the workbook is written.')
+    ap.add_argument('--cache_dir', default='.cache',
+                    help='Where the parsed SQL and per-query parquet results are cached between runs.')
+    ap.add_argument('--no_cache', action='store_true',
+                    help='Always re-parse the solved SQL and re-run every query.')
     args = ap.parse_args()
 
     if not args.password:
@@ -170,15 +569,15 @@ def main():
     dataset_sql_text = read_text(args.dataset_sql)
     solved_sql_text = read_text(args.solved_sql)
 
-    setup_statements, queries = extract_setup_and_queries(solved_sql_text)
+    setup_statements, queries = load_setup_and_queries(solved_sql_text, None if args.no_cache else args.cache_dir)
 
     # First connect without choosing DB so dataset file can create it
+    conn_args = dict(host=args.host, port=args.port, user=args.user, password=args.password,
+                     use_pure=not HAVE_CEXT)
+    if not HAVE_CEXT:
+        print(">> mysql-connector C extension not available; using the pure-Python protocol")
     try:
-        cnx = mysql.connector.connect(
-            host=args.host, port=args.port,
-            user=args.user, password=args.password,
-            autocommit=True
-        )
+        cnx = mysql.connector.connect(autocommit=False, **conn_args)
     except mysql.connector.Error as err:
         print(f"Error connecting to MySQL: {err}")
         sys.exit(1)
@@ -186,12 +585,15 @@ def main():
     cur = cnx.cursor()
 
     if not args.skip_setup:
+        set_bulk_load_mode(cur, True)
         print(">> Running dataset schema & seed ...")
-        run_statements(cur, split_mysql_statements(dataset_sql_text), echo=True)
+        run_statements(cur, split_mysql_statements(dataset_sql_text), echo=True, cnx=cnx)
         print(">> Running solved pre-Segment-1 setup ...")
-        run_statements(cur, setup_statements, echo=True)
+        run_statements(cur, setup_statements, echo=True, cnx=cnx)
+        set_bulk_load_mode(cur, False)
     else:
         print(">> Skipping setup (--skip_setup)")
+    cnx.autocommit = True
 
     # USE database
     try:
@@ -200,41 +602,61 @@ def main():
         print(f"Failed to USE database {args.database}: {e}")
         sys.exit(1)
 
+    try:
+        pool = MySQLConnectionPool(pool_name='imdb', pool_size=args.workers,
+                                   database=args.database, autocommit=True,
+                                   get_warnings=False, raise_on_warnings=False, **conn_args)
+    except mysql.connector.Error as err:
+        print(f"Error creating MySQL connection pool: {err}")
+        sys.exit(1)
+
     os.makedirs(args.csv_dir, exist_ok=True)
-    writer = pd.ExcelWriter(args.excel_out, engine='openpyxl')
 
-    print(f">> Executing {len(queries)} queries ...")
-    for qkey in sorted(queries.keys()):
-        label = queries[qkey]['label']
-        sql = queries[qkey]['sql']
-        print(f"[{qkey}] {label}")
+    # With --skip_setup the DB may hold anything, so cached results can't be trusted
+    use_cache = not args.no_cache and not args.skip_setup and HAVE_PYARROW
+    if use_cache:
+        os.makedirs(args.cache_dir, exist_ok=True)
+    elif args.skip_setup and not args.no_cache:
+        print(">> Result cache bypassed (--skip_setup: database state unknown)")
+    elif not args.no_cache:
+        print(">> Result cache disabled (pip install pyarrow to enable)")
+    # Cached results are tied to the server/database and the dataset + setup that produced them
+    data_version = hashlib.sha256('\0'.join(
+        [args.host, str(args.port), args.database, dataset_sql_text] + setup_statements).encode('utf-8')).hexdigest()
+    solved_mtime = os.path.getmtime(args.solved_sql)
 
-        try:
-            cur.execute(sql)
-            rows = cur.fetchall()
-            cols = [d[0] for d in cur.description] if cur.description else []
-            df = pd.DataFrame(rows, columns=cols)
-        except mysql.connector.Error as e:
-            df = pd.DataFrame({'error': [str(e)], 'query': [sql]})
+    for qkey, q in queries.items():
+        q['csv'] = os.path.join(args.csv_dir, f"{qkey}.csv")
+        if use_cache:
+            q['cache'] = result_cache_path(args.cache_dir, qkey, q['sql'], data_version)
 
-        # Sheet name (<=31 chars)
-        sheet_name = f"{qkey}_{label}"
-        for bad, repl in [('/', '_'), ('\\', '_'), (':', ' '), ('*', ' '), ('?', ' '), ('[', '('), (']', ')')]:
-            sheet_name = sheet_name.replace(bad, repl)
-        if len(sheet_name) > 31:
-            sheet_name = sheet_name[:31]
+    print(f">> Executing {len(queries)} queries ({args.workers} workers) ...")
+    # The workbook is not thread-safe: sheets are written sequentially, in order,
+    # while the following queries are still executing on the pool
+    with (nullcontext() if args.skip_excel else open_workbook(args.excel_out)) as book:
+        for qkey, result in run_queries(pool, queries, args.workers, min_mtime=solved_mtime,
+                                        max_buffered=None if args.skip_excel else args.max_buffered_results,
+                                        fetch_size=args.fetch_size, keep_rows=not args.skip_excel):
+            q = queries[qkey]
+            print(f"[{qkey}] {q['label']}")
 
-        try:
-            df.to_excel(writer, index=False, sheet_name=sheet_name)
-        except Exception:
-            df.to_excel(writer, index=False, sheet_name=qkey)
+            if isinstance(result, mysql.connector.Error):
+                cols, rows = ['error', 'query'], [(str(result), q['sql'])]
+                write_csv(q['csv'], cols, rows)
+            else:
+                cols, rows = result
 
-        df.to_csv(os.path.join(args.csv_dir, f"{qkey}.csv"), index=False, encoding='utf-8')
+            if book is None:
+                continue
+            try:
+                write_sheet(book, q['sheet'], cols, rows)
+            except Exception:
+                write_sheet(book, qkey, cols, rows)
 
-    writer.close()
     cur.close()
     cnx.close()
-    print(f">> Done. Excel: {args.excel_out} | CSV dir: {args.csv_dir}")
+    excel_note = "skipped" if args.skip_excel else args.excel_out
+    print(f">> Done. Excel: {excel_note} | CSV dir: {args.csv_dir}")
 
 if __name__ == '__main__':
     main()